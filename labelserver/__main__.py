@@ -0,0 +1,30 @@
+"""Production entrypoint: ``python -m labelserver``.
+
+Kept separate from main.py so the supervisor process doesn't import the app
+(and scan the blob cache) just to spawn workers.
+"""
+import os
+
+import uvicorn
+
+from .config import settings
+
+
+def main():
+    # Each worker holds its own index cache, so the count is a setting rather
+    # than 2n+1; 0 opts into the CPU-based default.
+    workers = settings.workers or (os.cpu_count() or 1) * 2 + 1
+    uvicorn.run(
+        "labelserver.main:app",
+        host="0.0.0.0",
+        port=settings.port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level=settings.log_level.lower(),
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
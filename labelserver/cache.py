@@ -1,8 +1,17 @@
 import asyncio
+import gzip
+import heapq
 import logging
 import os
-from collections import OrderedDict
+import shutil
+import threading
+import zlib
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, islice
 
+from azure.core import MatchConditions
 from azure.storage.blob import BlobServiceClient
 
 from .config import settings
@@ -31,15 +40,145 @@ class AssetStatus:
         return d
 
 
+class CacheEntry:
+    """Size, last-access tick and sampling slot of one cached file."""
+    __slots__ = ("size", "tick", "pos")
+
+    def __init__(self, size: int, tick: int):
+        self.size = size
+        self.tick = tick
+        self.pos = -1  # index into CacheTier.keys
+
+
+class CacheTier:
+    """Files cached under one directory, with a running total of their size.
+
+    Mutated from the event loop and from eviction threads, so every change
+    goes through the tier's lock. keys mirrors files so eviction can sample
+    entries in O(1) without copying the key set.
+    """
+    __slots__ = ("root", "max_bytes", "files", "keys", "total_bytes", "lock")
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.files: dict[str, CacheEntry] = {}  # path relative to root -> entry
+        self.keys: list[str] = []
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, key: str, entry: CacheEntry):
+        with self.lock:
+            self._pop(key)
+            entry.pos = len(self.keys)
+            self.keys.append(key)
+            self.files[key] = entry
+            self.total_bytes += entry.size
+
+    def pop(self, key: str) -> CacheEntry | None:
+        with self.lock:
+            return self._pop(key)
+
+    def pop_victim(self, samples: int) -> str | None:
+        """If over budget, remove and return the stalest of a few random entries."""
+        with self.lock:
+            keys = self.keys
+            if self.total_bytes <= self.max_bytes or not keys:
+                return None
+            sample = [keys[random.randrange(len(keys))] for _ in range(min(samples, len(keys)))]
+            victim = min(sample, key=lambda k: self.files[k].tick)
+            self._pop(victim)
+            return victim
+
+    def _pop(self, key: str) -> CacheEntry | None:
+        # Caller holds self.lock; swap-remove keeps keys dense
+        entry = self.files.pop(key, None)
+        if entry is not None:
+            last = self.keys.pop()
+            if last != key:
+                self.keys[entry.pos] = last
+                self.files[last].pos = entry.pos
+            self.total_bytes -= entry.size
+        return entry
+
+
+def _try_stat(path: str) -> int | None:
+    """Size of the file at path, or None if it does not exist (one syscall)."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def _iter_scandir(path: str, skip: str | None = None):
+    """Yield (path, stat) for every file under path; dirent stats avoid extra lookups."""
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path != skip:
+                        yield from _iter_scandir(entry.path, skip)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+
+class _GunzipWriter:
+    """Incrementally gunzips bytes into a file object (multi-member safe)."""
+
+    def __init__(self, f):
+        self._f = f
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.size = 0
+
+    def write(self, data: bytes):
+        while data:
+            out = self._inflater.decompress(data)
+            self._f.write(out)
+            self.size += len(out)
+            if not self._inflater.eof:
+                return
+            # Start of the next gzip member, if any
+            data = self._inflater.unused_data
+            self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def flush(self):
+        out = self._inflater.flush()
+        self._f.write(out)
+        self.size += len(out)
+
+
 class LabelBlobCache:
-    """LRU disk cache for .json.gz annotation files from Azure Blob."""
+    """LRU disk cache for .json.gz annotation files from Azure Blob.
+
+    A second tier under ``raw/`` keeps decompressed copies so index rebuilds
+    after eviction skip gunzip. Each tier is size-bounded independently.
+    """
+
+    RAW_DIR = "raw"
+    DOWNLOAD_CONCURRENCY = 16                  # parallel range GETs per blob
+    DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+    LOCK_SHARDS = 256                          # power of two
+    EVICTION_SAMPLES = 5
 
     def __init__(self):
         self.cache_dir = settings.cache_dir
-        self.max_bytes = int(settings.cache_max_size_gb * 1024 * 1024 * 1024)
-        self._locks: dict[str, asyncio.Lock] = {}
-        self._lock_guard = asyncio.Lock()
-        self._files: OrderedDict[str, int] = OrderedDict()  # path -> size
+        self.raw_dir = os.path.join(self.cache_dir, self.RAW_DIR)
+        # Fixed pool of locks; distinct blobs may occasionally share one
+        self._lock_shards = [asyncio.Lock() for _ in range(self.LOCK_SHARDS)]
+        # Approximate LRU: entries carry an access tick; no reordering on hits
+        self._clock = count()
+        self._gz_tier = CacheTier(
+            self.cache_dir, int(settings.cache_max_size_gb * 1024 * 1024 * 1024)
+        )
+        self._raw_tier = CacheTier(
+            self.raw_dir, int(settings.raw_cache_max_size_gb * 1024 * 1024 * 1024)
+        )
         self._status: dict[str, AssetStatus] = {}  # blob_path -> status
         self._blob_client = BlobServiceClient.from_connection_string(
             settings.azure_storage_connection_string
@@ -47,82 +186,130 @@ class LabelBlobCache:
         self._container = self._blob_client.get_container_client(
             settings.azure_container_name
         )
-        os.makedirs(self.cache_dir, exist_ok=True)
+        os.makedirs(self.raw_dir, exist_ok=True)
         self._scan_existing()
 
     def _scan_existing(self):
         """Rebuild LRU tracking from existing cached files."""
-        entries = []
-        for root, _, files in os.walk(self.cache_dir):
-            for f in files:
-                full = os.path.join(root, f)
-                try:
-                    stat = os.stat(full)
-                    entries.append((full, stat.st_size, stat.st_atime))
-                except OSError:
-                    continue
-        # Sort by access time (oldest first = evict first)
-        entries.sort(key=lambda e: e[2])
-        for path, size, _ in entries:
-            rel = os.path.relpath(path, self.cache_dir)
-            self._files[rel] = size
-        total_mb = sum(self._files.values()) / (1024 * 1024)
-        logger.info(f"Cache scan: {len(self._files)} files, {total_mb:.0f} MB")
-
-    async def _get_lock(self, blob_path: str) -> asyncio.Lock:
-        async with self._lock_guard:
-            if blob_path not in self._locks:
-                self._locks[blob_path] = asyncio.Lock()
-            return self._locks[blob_path]
+        self._scan_tier(self._gz_tier, skip=self.raw_dir)
+        self._scan_tier(self._raw_tier)
+        raw_mb = self._raw_tier.total_bytes / (1024 * 1024)
+        logger.info("Cache scan: %d files, %.0f MB (+%d raw, %.0f MB)",
+                    self.file_count, self.total_cached_mb, len(self._raw_tier.files), raw_mb)
+
+    def _scan_tier(self, tier: CacheTier, skip: str | None = None):
+        # Min-heap on access time (oldest first = evict first)
+        heap: list[tuple[float, str, int]] = []
+        prefix_len = len(os.path.join(tier.root, ""))
+        for path, stat in _iter_scandir(tier.root, skip):
+            heapq.heappush(heap, (stat.st_atime, path[prefix_len:], stat.st_size))
+        while heap:
+            _, rel, size = heapq.heappop(heap)
+            tier.put(rel, CacheEntry(size, next(self._clock)))
+
+    def _lock_for(self, path: str) -> asyncio.Lock:
+        return self._lock_shards[hash(path) & (self.LOCK_SHARDS - 1)]
 
     def _local_path(self, blob_path: str) -> str:
         return os.path.join(self.cache_dir, blob_path)
 
+    @staticmethod
+    def _raw_key(blob_path: str) -> str:
+        return blob_path[:-3] if blob_path.endswith(".gz") else blob_path
+
+    def _raw_path(self, raw_key: str) -> str:
+        return os.path.join(self.raw_dir, raw_key)
+
+    def cached_size(self, blob_path: str) -> int | None:
+        """Size of the cached .json.gz as tracked at download/scan time (no syscall)."""
+        entry = self._gz_tier.files.get(blob_path)
+        return entry.size if entry is not None else None
+
     def get_status(self, blob_path: str) -> AssetStatus:
         """Get current status of a blob."""
         if blob_path in self._status:
             return self._status[blob_path]
-        local = self._local_path(blob_path)
-        if os.path.exists(local):
-            return AssetStatus("cached", 1.0, os.path.getsize(local))
+        size = _try_stat(self._local_path(blob_path))
+        if size is not None:
+            return AssetStatus("cached", 1.0, size)
         return AssetStatus("unknown")
 
     async def get(self, blob_path: str) -> str:
         """Get local path to cached .json.gz, downloading if needed."""
         local = self._local_path(blob_path)
 
-        if os.path.exists(local):
-            # Move to end of LRU
-            if blob_path in self._files:
-                self._files.move_to_end(blob_path)
-            self._status[blob_path] = AssetStatus("cached", 1.0, os.path.getsize(local))
+        size = _try_stat(local)
+        if size is not None:
+            self._touch(self._gz_tier, blob_path, size)
+            self._status[blob_path] = AssetStatus("cached", 1.0, size)
             return local
 
-        lock = await self._get_lock(blob_path)
+        lock = self._lock_for(blob_path)
         async with lock:
             # Double-check after acquiring lock
-            if os.path.exists(local):
-                if blob_path in self._files:
-                    self._files.move_to_end(blob_path)
-                self._status[blob_path] = AssetStatus("cached", 1.0, os.path.getsize(local))
+            size = _try_stat(local)
+            if size is not None:
+                self._touch(self._gz_tier, blob_path, size)
+                self._status[blob_path] = AssetStatus("cached", 1.0, size)
                 return local
 
             self._status[blob_path] = AssetStatus("downloading")
-            logger.info(f"Downloading: {blob_path}")
+            logger.info("Downloading: %s", blob_path)
+            # Gunzip into the raw tier in the same pass as the download
+            raw_key = self._raw_key(blob_path)
+            raw = self._raw_path(raw_key) if blob_path.endswith(".gz") else None
             try:
-                await asyncio.to_thread(self._download, blob_path, local)
+                size, raw_size = await asyncio.to_thread(self._download, blob_path, local, raw)
             except Exception as e:
                 self._status[blob_path] = AssetStatus("error", error=str(e))
                 raise
-            size = os.path.getsize(local)
-            self._files[blob_path] = size
-            self._files.move_to_end(blob_path)
+            self._gz_tier.put(blob_path, CacheEntry(size, next(self._clock)))
+            if raw_size is not None:
+                self._raw_tier.put(raw_key, CacheEntry(raw_size, next(self._clock)))
             self._status[blob_path] = AssetStatus("cached", 1.0, size)
             await asyncio.to_thread(self._evict_if_needed)
-            logger.info(f"Cached: {blob_path} ({size / 1024 / 1024:.0f} MB)")
+            logger.info("Cached: %s (%.0f MB)", blob_path, size / 1024 / 1024)
             return local
 
-    def _download(self, blob_path: str, local_path: str):
+    async def get_raw(self, blob_path: str) -> str:
+        """Get local path to a decompressed copy of the blob, creating it if needed."""
+        raw_key = self._raw_key(blob_path)
+        raw = self._raw_path(raw_key)
+
+        size = _try_stat(raw)
+        if size is not None:
+            self._touch(self._raw_tier, raw_key, size)
+            return raw
+
+        local = await self.get(blob_path)
+        if not local.endswith(".gz"):
+            return local  # already plain JSON
+
+        lock = self._lock_for(raw)
+        async with lock:
+            if _try_stat(raw) is not None:
+                return raw
+            size = await asyncio.to_thread(self._decompress, local, raw)
+            self._raw_tier.put(raw_key, CacheEntry(size, next(self._clock)))
+            await asyncio.to_thread(self._evict_if_needed)
+            logger.info("Decompressed: %s (%.0f MB)", blob_path, size / 1024 / 1024)
+            return raw
+
+    def _decompress(self, gz_path: str, raw_path: str) -> int:
+        os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+        tmp = raw_path + ".tmp"
+        with gzip.open(gz_path, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+            size = dst.tell()
+        os.rename(tmp, raw_path)
+        return size
+
+    def _download(self, blob_path: str, local_path: str,
+                  raw_path: str | None = None) -> tuple[int, int | None]:
+        """Download blob to local_path, optionally gunzipping into raw_path on the fly.
+
+        Returns (bytes written, decompressed size or None if raw_path is not given).
+        """
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         tmp = local_path + ".tmp"
         blob = self._container.get_blob_client(blob_path)
@@ -132,26 +319,79 @@ class LabelBlobCache:
         if status:
             status.size_bytes = total_bytes
 
-        stream = blob.download_blob()
+        raw_f = gunzip = None
+        if raw_path is not None:
+            os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+            raw_f = open(raw_path + ".tmp", "wb")
+            gunzip = _GunzipWriter(raw_f)
+
         downloaded = 0
-        with open(tmp, "wb") as f:
-            for chunk in stream.chunks():
-                f.write(chunk)
-                downloaded += len(chunk)
-                if status and total_bytes > 0:
-                    status.progress = downloaded / total_bytes
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in self._iter_ranges(blob, total_bytes, props.etag):
+                    f.write(chunk)
+                    if gunzip:
+                        gunzip.write(chunk)
+                    downloaded += len(chunk)
+                    if status and total_bytes > 0:
+                        status.progress = downloaded / total_bytes
+            if gunzip:
+                gunzip.flush()
+        finally:
+            if raw_f:
+                raw_f.close()
+
+        if raw_path is not None:
+            os.rename(raw_path + ".tmp", raw_path)
         os.rename(tmp, local_path)
+        return downloaded, (gunzip.size if gunzip else None)
+
+    def _iter_ranges(self, blob, total_bytes: int, etag: str):
+        """Yield the blob's bytes in order while fetching ranges concurrently.
+
+        Keeps up to DOWNLOAD_CONCURRENCY range GETs in flight, so at most
+        DOWNLOAD_CONCURRENCY * DOWNLOAD_CHUNK_BYTES are buffered at once.
+        """
+        def fetch(offset: int) -> bytes:
+            length = min(self.DOWNLOAD_CHUNK_BYTES, total_bytes - offset)
+            return blob.download_blob(
+                offset=offset, length=length,
+                etag=etag, match_condition=MatchConditions.IfNotModified,
+            ).readall()
+
+        offsets = iter(range(0, total_bytes, self.DOWNLOAD_CHUNK_BYTES))
+        with ThreadPoolExecutor(max_workers=self.DOWNLOAD_CONCURRENCY,
+                                thread_name_prefix="blob-range") as pool:
+            pending = deque(pool.submit(fetch, off)
+                            for off in islice(offsets, self.DOWNLOAD_CONCURRENCY))
+            while pending:
+                chunk = pending.popleft().result()
+                nxt = next(offsets, None)
+                if nxt is not None:
+                    pending.append(pool.submit(fetch, nxt))
+                yield chunk
 
     def _evict_if_needed(self):
-        total = sum(self._files.values())
-        while total > self.max_bytes and self._files:
-            oldest_key, oldest_size = next(iter(self._files.items()))
-            local = self._local_path(oldest_key)
+        self._evict_tier(self._gz_tier)
+        self._evict_tier(self._raw_tier)
+
+    def _touch(self, tier: CacheTier, key: str, size: int | None = None):
+        entry = tier.files.get(key)
+        if entry is not None:
+            entry.tick = next(self._clock)
+        elif size is not None:
+            # Written by another worker process sharing the cache dir
+            tier.put(key, CacheEntry(size, next(self._clock)))
+
+    def _evict_tier(self, tier: CacheTier):
+        # Evict the least recently used of a few randomly sampled entries
+        while (oldest_key := tier.pop_victim(self.EVICTION_SAMPLES)) is not None:
+            local = os.path.join(tier.root, oldest_key)
             try:
                 os.remove(local)
                 # Clean empty parent directories
                 parent = os.path.dirname(local)
-                while parent != self.cache_dir:
+                while parent != tier.root:
                     if not os.listdir(parent):
                         os.rmdir(parent)
                         parent = os.path.dirname(parent)
@@ -159,26 +399,29 @@ class LabelBlobCache:
                         break
             except OSError:
                 pass
-            del self._files[oldest_key]
-            total -= oldest_size
-            logger.info(f"Evicted: {oldest_key}")
+            logger.info("Evicted: %s", oldest_key)
 
     def remove(self, blob_path: str):
         local = self._local_path(blob_path)
         try:
             os.remove(local)
-            if blob_path in self._files:
-                del self._files[blob_path]
+            self._gz_tier.pop(blob_path)
+        except OSError:
+            pass
+        raw_key = self._raw_key(blob_path)
+        try:
+            os.remove(self._raw_path(raw_key))
+            self._raw_tier.pop(raw_key)
         except OSError:
             pass
 
     @property
     def total_cached_mb(self) -> float:
-        return sum(self._files.values()) / (1024 * 1024)
+        return self._gz_tier.total_bytes / (1024 * 1024)
 
     @property
     def file_count(self) -> int:
-        return len(self._files)
+        return len(self._gz_tier.files)
 
 
 label_blob_cache = LabelBlobCache()
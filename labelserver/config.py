@@ -5,12 +5,21 @@ class Settings(BaseSettings):
     azure_container_name: str = "media"
     cache_dir: str = "/data/label-cache"     # disk cache for .json.gz files
     cache_max_size_gb: float = 50.0          # smaller than tile cache
+    raw_cache_max_size_gb: float = 100.0     # decompressed .json tier under cache_dir/raw
     max_indexed_jobs: int = 50               # max R-tree indexes in memory
     max_index_memory_mb: float = 8192        # 8GB ceiling for all indexes
     api_key: str = ""                        # static key for server-to-server calls
     jwt_secret: str = ""                     # shared secret for JWT validation (browser clients)
     django_api_url: str = ""                 # azure-studio URL for writeback
     chunk_size: int = 4096                   # spatial chunk size in image pixels
+    log_level: str = "WARNING"               # app loggers and uvicorn; INFO shows cache/index events
+    port: int = 8889                         # HTTP port for python -m labelserver
+    workers: int = 4                         # uvicorn workers, each with its own caches; 0 = 2*cpus+1
+    build_processes: int = 0                 # bbox process pool per worker; 0 = cpus // workers
+    response_cache_mb: float = 1024          # /labels response bodies kept across all blobs
+    bbox_dtype: str = "int32"                # label bbox storage; "float32" keeps sub-pixel bounds
+    inline_label_threshold: int = 5000       # indexes smaller than this are queried on the event loop
+    inline_area_threshold: float = 262144    # px^2; tree-backed queries below this run inline too
 
     class Config:
         env_file = ".env"
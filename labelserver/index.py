@@ -1,41 +1,348 @@
 import gzip
 import hashlib
 import io
-import json
 import logging
 import math
+import mmap
+import multiprocessing
 import os
+import random
+import sys
+import threading
 import time
-from collections import OrderedDict
+from array import array
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from functools import lru_cache
-from rtree import index as rtree_index
+from typing import Any
+
+import msgspec
+import numba
+import numpy as np
+import orjson
+import shapely
+import simdjson
 
 from PIL import Image, ImageDraw
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+_bbox_pool: ProcessPoolExecutor | None = None
+_bbox_pool_lock = threading.Lock()
+
+_NO_HITS = np.empty(0, dtype=np.int64)
+
+# LabelIndex.kinds codes
+KIND_NONE, KIND_POLYGON, KIND_POINT, KIND_BOX = 0, 1, 2, 3
+
+class _LabelMeta(msgspec.Struct):
+    """The few label fields LOD needs; geometry is parsed past, never materialized."""
+    id: Any = msgspec.field(default=None, name="_id")
+    label_class: Any = ""
+    label_type: Any = "cell"
+    source: Any = ""
+
+class _Position(msgspec.Struct):
+    x: float
+    y: float
+
+class SimplifiedLabel(msgspec.Struct):
+    """Centroid-only stand-in for a label in over-budget LOD responses."""
+    id: Any = msgspec.field(name="_id")
+    label_class: Any
+    label_type: Any
+    source: Any
+    position: _Position
+    simplified: bool = msgspec.field(default=True, name="_simplified")
+
+_decode_label_meta = msgspec.json.Decoder(_LabelMeta).decode
+_encode_json = msgspec.json.Encoder().encode
+
+def _get_bbox_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Lazily start the shared process pool used for bbox extraction."""
+    global _bbox_pool
+    with _bbox_pool_lock:
+        if _bbox_pool is None:
+            # spawn, not fork: builds run from threads of a multi-threaded server
+            _bbox_pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _bbox_pool
+
+def shutdown_bbox_pool():
+    """Stop the bbox process pool, if it was ever started."""
+    global _bbox_pool
+    with _bbox_pool_lock:
+        if _bbox_pool is not None:
+            _bbox_pool.shutdown(wait=False, cancel_futures=True)
+            _bbox_pool = None
+
+def _flatten_geometry(label: dict, xs: array, ys: array) -> int:
+    """Append the points that determine a label's bounding box to xs/ys.
+
+    Returns the label's KIND_* code.
+    """
+    # Polygons: have 'regions' field  [[{x,y}, {x,y}, ...], ...]
+    regions = label.get('regions')
+    if regions:
+        for ring in regions:
+            for pt in ring:
+                xs.append(pt['x'])
+                ys.append(pt['y'])
+        return KIND_POLYGON
+
+    # Points: have 'position' field {x, y}
+    pos = label.get('position')
+    if pos:
+        xs.append(pos['x'])
+        ys.append(pos['y'])
+        return KIND_POINT
+
+    # Boxes: have 'centre' + 'size'; two opposite corners span the box
+    centre = label.get('centre')
+    size = label.get('size')
+    if centre and size:
+        half_w, half_h = size['x'] / 2, size['y'] / 2
+        xs.append(centre['x'] - half_w)
+        ys.append(centre['y'] - half_h)
+        xs.append(centre['x'] + half_w)
+        ys.append(centre['y'] + half_h)
+        return KIND_BOX
+
+    return KIND_NONE
+
+def _segment_hits_rect(x0: float, y0: float, x1: float, y1: float,
+                      min_x: float, min_y: float, max_x: float, max_y: float) -> bool:
+    """Liang-Barsky clip: does segment (x0,y0)-(x1,y1) touch the rect?"""
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - min_x), (dx, max_x - x0), (-dy, y0 - min_y), (dy, max_y - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            t = q / p
+            if t > t1:
+                return False
+            t0 = max(t0, t)
+        else:
+            t = q / p
+            if t < t0:
+                return False
+            t1 = min(t1, t)
+    return True
+
+def _polygon_intersects_rect(regions: list, bbox: tuple) -> bool:
+    """Exact test of polygon rings ([[{x,y}, ...], ...]) against an axis-aligned bbox."""
+    min_x, min_y, max_x, max_y = bbox
+    # Any outline segment (or vertex) inside the rect
+    for ring in regions:
+        pts = [(pt['x'], pt['y']) for pt in ring]
+        for (x0, y0), (x1, y1) in zip(pts, pts[1:] + pts[:1]):
+            if _segment_hits_rect(x0, y0, x1, y1, min_x, min_y, max_x, max_y):
+                return True
+    # No outline crosses the rect: either it lies wholly inside the polygon or
+    # wholly outside. Even-odd test on one corner over all rings (holes included).
+    inside = False
+    for ring in regions:
+        pts = [(pt['x'], pt['y']) for pt in ring]
+        for (x0, y0), (x1, y1) in zip(pts, pts[1:] + pts[:1]):
+            if (y0 > min_y) != (y1 > min_y) and min_x < x0 + (min_y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+@numba.njit(cache=True)
+def _run_bounds(xs: np.ndarray, ys: np.ndarray, a: int, b: int):
+    """Min/max over one point run xs[a:b], ys[a:b]; empty runs give an empty interval."""
+    min_x, min_y, max_x, max_y = np.inf, np.inf, -np.inf, -np.inf
+    for j in range(a, b):
+        x, y = xs[j], ys[j]
+        if x < min_x:
+            min_x = x
+        if x > max_x:
+            max_x = x
+        if y < min_y:
+            min_y = y
+        if y > max_y:
+            max_y = y
+    return min_x, min_y, max_x, max_y
+
+@numba.njit(cache=True)
+def _reduce_bboxes(xs: np.ndarray, ys: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Min/max over each label's point run xs[starts[i]:starts[i+1]].
+
+    Labels without points get an empty interval, which never intersects a query.
+    Serial, so it is safe to call from several server threads at once.
+    """
+    n = len(starts) - 1
+    out = np.empty((4, n), dtype=np.float32)
+    for i in range(n):
+        out[0, i], out[1, i], out[2, i], out[3, i] = _run_bounds(xs, ys, starts[i], starts[i + 1])
+    return out
+
+def _shard_bboxes(labels_raw: bytes, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Compute float32 (4, n) bboxes and uint8 kinds for n comma-separated labels.
+
+    Runs in pool workers, so only raw bytes go in and compact arrays come
+    out. Geometry is staged as flat xs/ys runs per label and reduced by a
+    Numba kernel; parallelism comes from sharding across the pool.
+    """
+    xs, ys = array('d'), array('d')
+    starts = array('q', [0])
+    kinds = array('B')
+    bounds = offsets.tolist()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        kinds.append(_flatten_geometry(orjson.loads(labels_raw[start + 1:end]), xs, ys))
+        starts.append(len(xs))
+    bboxes = _reduce_bboxes(
+        np.frombuffer(xs, dtype=np.float64),
+        np.frombuffer(ys, dtype=np.float64),
+        np.frombuffer(starts, dtype=np.int64),
+    )
+    return bboxes, np.frombuffer(kinds, dtype=np.uint8)
+
+def _to_bbox_dtype(bboxes: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Cast float32 (4, n) bboxes to the storage dtype.
+
+    Integer dtypes round outward (floor mins, ceil maxes) so a stored bbox
+    always contains the true one; the empty interval of labels without
+    geometry becomes (max, max, min, min) of the dtype.
+    """
+    if not np.issubdtype(dtype, np.integer):
+        return bboxes.astype(dtype, copy=False)
+    info = np.iinfo(dtype)
+    wide = bboxes.astype(np.float64)  # float32 can't represent int32 limits exactly
+    np.floor(wide[:2], out=wide[:2])
+    np.ceil(wide[2:], out=wide[2:])
+    np.clip(wide, info.min, info.max, out=wide)
+    return wide.astype(dtype)
+
+@contextmanager
+def _open_document(path: str):
+    """Yield the decompressed annotation JSON as a bytes-like buffer.
+
+    Plain files are mmapped read-only so the parse reads straight from the
+    kernel page cache; the mapping is closed once the labels are copied out.
+    """
+    # Handle both .json.gz and plain .json files
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            yield f.read()
+        return
+    with open(path, 'rb') as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+@dataclass(slots=True)
 class LabelIndex:
     """In-memory spatial index for one annotation file."""
     blob_path: str
-    labels: list[dict]                         # raw label dicts
-    centroids: list[tuple[float, float]]       # pre-computed (cx, cy) per label
-    rtree: rtree_index.Index = field(repr=False)
+    labels_raw: bytes = field(repr=False)      # minified JSON array of all labels
+    offsets: np.ndarray = field(repr=False)    # int64 (N+1,): separator positions, label i = labels_raw[offsets[i]+1:offsets[i+1]]
+    bboxes: np.ndarray = field(repr=False)     # (4, N) rows minX, minY, maxX, maxY; dtype per bbox_dtype
+    kinds: np.ndarray = field(repr=False)      # uint8 (N,): KIND_* geometry code
+    valid_ids: np.ndarray = field(repr=False)  # int32 ids of labels that have geometry
+    rtree: shapely.STRtree | None = field(repr=False)  # only built for large N; tree index k -> valid_ids[k]
     label_count: int = 0
+    polygon_count: int = 0                     # labels whose refinement needs a geometry test
     image_width: int = 0                       # bounding box of all labels
     image_height: int = 0
+    extent: tuple[float, float, float, float] | None = None  # union of all label bboxes
     memory_estimate_mb: float = 0.0
     last_accessed: float = 0.0
+    labels_gz: bytes | None = field(default=None, repr=False)
+    buckets: dict[tuple[int, int], np.ndarray] = field(default_factory=dict, repr=False)  # (tx, ty) -> label ids
+    version: int = -1                          # manager version once published; -1 if never cached
+    source_stamp: tuple[int, int] = (0, 0)     # (st_size, st_mtime_ns) of the cached file it was built from
+
+    def label(self, i: int) -> dict:
+        """Decode a single label dict from its raw JSON bytes."""
+        return orjson.loads(self.labels_raw[self.offsets[i] + 1:self.offsets[i + 1]])
+
+    def encode(self, indices: np.ndarray) -> bytes:
+        """Splice the given labels into a JSON array without decoding them."""
+        if len(indices) == self.label_count:
+            return self.labels_raw
+        raw = memoryview(self.labels_raw)
+        starts = (self.offsets[indices] + 1).tolist()
+        ends = self.offsets[indices + 1].tolist()
+        return b'[' + b','.join([raw[a:b] for a, b in zip(starts, ends)]) + b']'
+
+    def iter_ndjson(self, indices: np.ndarray, batch: int = 1024) -> Iterator[bytes]:
+        """Yield the given labels as NDJSON lines, `batch` labels per chunk."""
+        raw = memoryview(self.labels_raw)
+        for k in range(0, len(indices), batch):
+            part = indices[k:k + batch]
+            starts = (self.offsets[part] + 1).tolist()
+            ends = self.offsets[part + 1].tolist()
+            yield b'\n'.join([raw[a:b] for a, b in zip(starts, ends)]) + b'\n'
+
+    def gzipped(self) -> bytes:
+        """Gzipped copy of the full label array, compressed once on first use."""
+        if self.labels_gz is None:
+            self.labels_gz = gzip.compress(self.labels_raw, compresslevel=6)
+        return self.labels_gz
+
+    @property
+    def bbox_dtype(self) -> np.dtype:
+        return self.bboxes.dtype
+
+    def query_bounds(self, bbox: tuple) -> tuple:
+        """Query bbox expressed in the bbox storage dtype.
+
+        For integer storage, lo = ceil(min) and hi = floor(max) give exactly the
+        same comparisons against integer bounds as the float query would,
+        without upcasting the whole array.
+        """
+        if not np.issubdtype(self.bboxes.dtype, np.integer):
+            return bbox
+        info = np.iinfo(self.bboxes.dtype)
+        min_x, min_y, max_x, max_y = bbox
+        return tuple(min(max(v, info.min), info.max) for v in (
+            math.ceil(min_x), math.ceil(min_y), math.floor(max_x), math.floor(max_y)))
+
+    def centroid(self, i: int) -> tuple[float, float]:
+        min_x, min_y, max_x, max_y = self.bboxes[:, i].tolist()
+        return (min_x + max_x) / 2, (min_y + max_y) / 2
 
 class SpatialIndexManager:
     """LRU cache of per-blob spatial indexes built from .json.gz files."""
 
-    def __init__(self, max_indexes: int = 50, max_memory_mb: float = 8192):
+    # Below this many labels a vectorized NumPy scan beats R-tree traversal
+    RTREE_MIN_LABELS = 200_000
+    # Rough STRtree footprint per entry (GEOS box polygon, Python wrapper, tree node)
+    RTREE_BYTES_PER_ENTRY = 300
+    # Below this many labels bbox extraction stays in-process
+    PARALLEL_MIN_LABELS = 50_000
+    # Approximate LRU: evict the stalest of this many randomly sampled indexes
+    EVICTION_SAMPLES = 5
+
+    def __init__(self, max_indexes: int = 50, max_memory_mb: float = 8192,
+                 chunk_size: int = 4096, bbox_dtype: str = "int32",
+                 build_processes: int = 1):
         self.max_indexes = max_indexes
         self.max_memory_mb = max_memory_mb
-        self._indexes: OrderedDict[str, LabelIndex] = OrderedDict()
-        self._index_status: dict[str, dict] = {}  # blob_path -> {"status", "progress", "error"}
+        self.chunk_size = chunk_size  # grid for pre-bucketed tile queries
+        self.bbox_dtype = np.dtype(bbox_dtype)
+        self.build_processes = build_processes  # bbox pool size; 1 keeps builds in-process
+        self._indexes: dict[str, LabelIndex] = {}  # approximate LRU via last_accessed
+        self._total_mb = 0.0  # running sums over _indexes
+        self._total_labels = 0
+        self._versions: dict[str, int] = {}  # bumped whenever an index is replaced or dropped
+        self._index_status: dict[str, dict] = {}  # blob_path -> {"status", "progress", "error", "failed_at"}
+        self._lock = threading.Lock()  # guards _indexes, the running sums and _versions
+        self.on_drop: Callable[[str], None] | None = None  # called (under _lock) when an index goes away
+
+    def is_indexed(self, blob_path: str) -> bool:
+        """True if the blob's index is loaded (no build, no LRU refresh)."""
+        return blob_path in self._indexes
+
+    def peek(self, blob_path: str) -> LabelIndex | None:
+        """Return the index if loaded, without refreshing its LRU timestamp."""
+        return self._indexes.get(blob_path)
 
     def get_index_status(self, blob_path: str) -> dict | None:
         """Get current indexing status without triggering a build."""
@@ -45,152 +352,270 @@ class SpatialIndexManager:
 
     def get_or_build(self, blob_path: str, local_path: str) -> LabelIndex:
         """Get existing index or build from local file."""
-        if blob_path in self._indexes:
-            self._indexes.move_to_end(blob_path)
-            self._indexes[blob_path].last_accessed = time.time()
-            return self._indexes[blob_path]
+        li = self._indexes.get(blob_path)
+        if li is not None:
+            li.last_accessed = time.time()
+            return li
 
         # Build new index
+        version = self.version(blob_path)
         self._index_status[blob_path] = {"status": "indexing", "progress": 0.0}
         try:
             label_index = self._build_index(blob_path, local_path)
         except Exception as e:
-            self._index_status[blob_path] = {"status": "error", "error": str(e)}
+            self._index_status[blob_path] = {"status": "error", "error": str(e), "failed_at": time.time()}
             raise
-        self._indexes[blob_path] = label_index
-        self._indexes.move_to_end(blob_path)
-        self._index_status[blob_path] = {"status": "ready"}
+        if self._insert(blob_path, label_index, version):
+            self._index_status[blob_path] = {"status": "ready"}
+        else:
+            # Invalidated mid-build: the caller still gets its result, but
+            # the blob isn't indexed
+            self._index_status.pop(blob_path, None)
         self._evict_if_needed()
         return label_index
 
     def _build_index(self, blob_path: str, local_path: str) -> LabelIndex:
-        """Parse annotation file and build R-tree index with pre-computed centroids."""
-        logger.info(f"Building spatial index: {blob_path}")
-
-        # Handle both .json.gz and plain .json files
-        if local_path.endswith('.gz'):
-            with gzip.open(local_path, 'rt', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            with open(local_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-        labels = data.get('labels', data) if isinstance(data, dict) else data
-
-        # Read image dimensions from metadata (primary) or fall back to label extent
-        meta_width = data.get('image_width') if isinstance(data, dict) else None
-        meta_height = data.get('image_height') if isinstance(data, dict) else None
-
-        idx = rtree_index.Index()
-        centroids: list[tuple[float, float]] = []
+        """Parse annotation file and build the spatial index with pre-computed bounding boxes."""
+        logger.info("Building spatial index: %s", blob_path)
+        st = os.stat(local_path)  # before parsing, so a concurrent replace only makes it look stale
+
+        # simdjson hands out lazy proxies, so labels are never materialized as
+        # Python dicts here; each one is kept only as its minified JSON bytes.
+        with _open_document(local_path) as src:
+            parser = simdjson.Parser()
+            doc = parser.parse(src)
+
+            is_object = isinstance(doc, simdjson.Object)
+            labels = doc.get('labels', doc) if is_object else doc
+
+            # Read image dimensions from metadata (primary) or fall back to label extent
+            meta_width = doc.get('image_width') if is_object else None
+            meta_height = doc.get('image_height') if is_object else None
+
+            n = len(labels)
+            chunks = [label.mini for label in labels]  # bytes
+            del labels, doc, parser
+
+        # Stored as a ready-to-send JSON array; offsets mark the '[' / ',' / ']'
+        # separators so any run of labels can be sliced out as-is.
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum([len(c) + 1 for c in chunks], out=offsets[1:])
+        labels_raw = b'[' + b','.join(chunks) + b']'
+        del chunks
+
+        bboxes, kinds = self._compute_bboxes(labels_raw, offsets)
+        bboxes = _to_bbox_dtype(bboxes, self.bbox_dtype)
+        valid = np.flatnonzero(bboxes[0] <= bboxes[2]).astype(np.int32)
+        extent = None
         max_x, max_y = 0.0, 0.0
+        if len(valid):
+            extent = (float(bboxes[0, valid].min()), float(bboxes[1, valid].min()),
+                      float(bboxes[2, valid].max()), float(bboxes[3, valid].max()))
+            max_x, max_y = max(0.0, extent[2]), max(0.0, extent[3])
 
-        for i, label in enumerate(labels):
-            bbox = self._compute_bbox(label)
-            if bbox:
-                idx.insert(i, bbox)
-                centroids.append(((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2))
-                max_x = max(max_x, bbox[2])
-                max_y = max(max_y, bbox[3])
-            else:
-                centroids.append((0.0, 0.0))
+        idx = None
+        if n > self.RTREE_MIN_LABELS and len(valid):
+            idx = self._bulk_load_rtree(valid, bboxes)
+        buckets = self._build_buckets(valid, bboxes)
 
         image_width = int(meta_width) if meta_width else int(math.ceil(max_x))
         image_height = int(meta_height) if meta_height else int(math.ceil(max_y))
         dims_source = "metadata" if meta_width and meta_height else "label_extent"
 
-        # Estimate memory from file size on disk
-        file_size = os.path.getsize(local_path)
-        if local_path.endswith('.gz'):
-            mem_mb = (file_size * 8) / (1024 * 1024)
-        else:
-            mem_mb = (file_size * 2) / (1024 * 1024)
-        logger.info(f"Indexed {len(labels)} labels, ~{mem_mb:.0f} MB, dims={image_width}x{image_height} ({dims_source})")
+        # Measure what the index actually holds instead of guessing from file size
+        mem_bytes = (len(labels_raw) + offsets.nbytes + bboxes.nbytes + kinds.nbytes + valid.nbytes
+                     + sys.getsizeof(buckets) + sum(ids.nbytes for ids in buckets.values()))
+        if idx is not None:
+            mem_bytes += len(valid) * self.RTREE_BYTES_PER_ENTRY
+        mem_mb = mem_bytes / (1024 * 1024)
+        logger.info("Indexed %d labels, ~%.0f MB, dims=%dx%d (%s)",
+                    n, mem_mb, image_width, image_height, dims_source)
 
         return LabelIndex(
             blob_path=blob_path,
-            labels=labels,
-            centroids=centroids,
+            labels_raw=labels_raw,
+            offsets=offsets,
+            bboxes=bboxes,
+            kinds=kinds,
+            valid_ids=valid,
             rtree=idx,
-            label_count=len(labels),
+            buckets=buckets,
+            label_count=n,
+            polygon_count=int(np.count_nonzero(kinds == KIND_POLYGON)),
             image_width=image_width,
             image_height=image_height,
+            extent=extent,
             memory_estimate_mb=mem_mb,
-            last_accessed=time.time()
+            last_accessed=time.time(),
+            source_stamp=(st.st_size, st.st_mtime_ns),
         )
 
-    def _compute_bbox(self, label: dict) -> tuple | None:
-        """Extract bounding box (minX, minY, maxX, maxY) from label geometry."""
-        # Polygons: have 'regions' field  [[{x,y}, {x,y}, ...], ...]
-        regions = label.get('regions')
-        if regions:
-            xs, ys = [], []
-            for ring in regions:
-                for pt in ring:
-                    xs.append(pt['x'])
-                    ys.append(pt['y'])
-            if not xs: return None
-            return (min(xs), min(ys), max(xs), max(ys))
-
-        # Points: have 'position' field {x, y}
-        pos = label.get('position')
-        if pos:
-            return (pos['x'], pos['y'], pos['x'], pos['y'])
-
-        # Boxes: have 'centre' + 'size'
-        centre = label.get('centre')
-        size = label.get('size')
-        if centre and size:
-            half_w, half_h = size['x'] / 2, size['y'] / 2
-            return (centre['x'] - half_w, centre['y'] - half_h,
-                    centre['x'] + half_w, centre['y'] + half_h)
-
-        return None
-
-    def query_bbox(self, blob_path: str, bbox: tuple) -> list[dict]:
-        """Return labels intersecting the given bounding box."""
-        li = self._indexes.get(blob_path)
-        if not li:
-            return []
+    def _compute_bboxes(self, labels_raw: bytes, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Compute all label bboxes and kinds, sharded across the process pool for large N."""
+        n = len(offsets) - 1
+        workers = self.build_processes
+        if n < self.PARALLEL_MIN_LABELS or workers <= 1:
+            return _shard_bboxes(labels_raw, offsets)
+
+        pool = _get_bbox_pool(workers)
+        bounds = np.linspace(0, n, workers + 1, dtype=np.int64)
+        futures = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            start, end = offsets[a], offsets[b]
+            futures.append(pool.submit(
+                _shard_bboxes, labels_raw[start:end], offsets[a:b + 1] - start
+            ))
+        results = [f.result() for f in futures]
+        return (np.hstack([bb for bb, _ in results]),
+                np.concatenate([k for _, k in results]))
+
+    def _bulk_load_rtree(self, ids: np.ndarray, bboxes: np.ndarray) -> shapely.STRtree:
+        """Build an STR-packed, in-memory GEOS tree over the given labels' bboxes."""
+        b = bboxes[:, ids]
+        return shapely.STRtree(shapely.box(b[0], b[1], b[2], b[3]))
+
+    def _build_buckets(self, ids: np.ndarray, bboxes: np.ndarray) -> dict[tuple[int, int], np.ndarray]:
+        """Assign each label to every chunk_size grid tile its bbox touches.
+
+        Tiles are closed intervals like R-tree queries, so a label on a tile
+        edge is listed in both neighbouring tiles.
+        """
+        if not len(ids):
+            return {}
+        cs = self.chunk_size
+        b = bboxes[:, ids].astype(np.float64) / cs
+        tx0 = np.ceil(b[0]).astype(np.int64) - 1
+        ty0 = np.ceil(b[1]).astype(np.int64) - 1
+        nx = np.floor(b[2]).astype(np.int64) - tx0 + 1
+        ny = np.floor(b[3]).astype(np.int64) - ty0 + 1
+
+        # Expand each label into one (tx, ty, id) row per covered tile
+        counts = nx * ny
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        nx_rep = np.repeat(nx, counts)
+        tx = np.repeat(tx0, counts) + k % nx_rep
+        ty = np.repeat(ty0, counts) + k // nx_rep
+        label_ids = np.repeat(ids.astype(np.int32), counts)
+
+        order = np.lexsort((ty, tx))
+        tx, ty, label_ids = tx[order], ty[order], label_ids[order]
+        cuts = np.flatnonzero((np.diff(tx) != 0) | (np.diff(ty) != 0)) + 1
+        starts = [0] + cuts.tolist()
+        return {
+            (int(tx[i]), int(ty[i])): group
+            for i, group in zip(starts, np.split(label_ids, cuts))
+        }
 
-        self._indexes.move_to_end(blob_path)
+    def _query_indices(self, li: LabelIndex, bbox: tuple, refine: bool = True) -> np.ndarray:
+        """Indices of labels intersecting the query bbox.
+
+        Filter on bounding boxes, then (if refine) drop polygons whose bbox
+        meets the query but whose outline doesn't.
+        """
+        min_x, min_y, max_x, max_y = bbox
+        ext = li.extent
+        if (ext is not None and min_x <= ext[0] and min_y <= ext[1]
+                and max_x >= ext[2] and max_y >= ext[3]):
+            # Zoomed out past every label: no traversal (or refinement) needed
+            return li.valid_ids
+        hits = self._candidate_indices(li, bbox)
+        return self._refine(li, hits, bbox) if refine else hits
+
+    def _candidate_indices(self, li: LabelIndex, bbox: tuple) -> np.ndarray:
+        """Indices of labels whose bbox intersects the query bbox."""
+        min_x, min_y, max_x, max_y = bbox
+        cs = self.chunk_size
+        if (max_x - min_x == cs and max_y - min_y == cs
+                and min_x % cs == 0 and min_y % cs == 0):
+            # Exactly one grid tile: answered by a dict lookup
+            return li.buckets.get((int(min_x // cs), int(min_y // cs)), _NO_HITS)
+        if li.rtree is not None:
+            # No predicate: envelope intersection, which is exact for box geometries
+            return np.sort(li.valid_ids[li.rtree.query(shapely.box(*bbox))])
+        # One contiguous row per coordinate; the mask is built in place, so
+        # the scan allocates a single boolean array however many rows it ANDs
+        min_x, min_y, max_x, max_y = li.query_bounds(bbox)
+        b = li.bboxes
+        mask = b[0] <= max_x
+        mask &= b[2] >= min_x
+        mask &= b[1] <= max_y
+        mask &= b[3] >= min_y
+        return np.flatnonzero(mask)
+
+    def _refine(self, li: LabelIndex, hits: np.ndarray, bbox: tuple) -> np.ndarray:
+        """Geometry pass over bbox candidates; only polygons are tested exactly.
+
+        Points and boxes are kept on their stored bbox. With integer storage
+        that bbox is rounded outward to whole pixels, so a point or box up to
+        1px outside the query can still be returned. Polygons whose bbox lies
+        inside the query trivially intersect it, so only polygons straddling
+        the query edge are decoded and tested.
+        """
+        min_x, min_y, max_x, max_y = li.query_bounds(bbox)
+        polys = np.flatnonzero(li.kinds[hits] == KIND_POLYGON)
+        if not len(polys):
+            return hits
+        # Only polygon candidates' coordinates are gathered
+        b = li.bboxes[:, hits[polys]]
+        inside = b[0] >= min_x
+        inside &= b[1] >= min_y
+        inside &= b[2] <= max_x
+        inside &= b[3] <= max_y
+        check = polys[~inside]
+        if not len(check):
+            return hits
+        keep = np.ones(len(hits), dtype=bool)
+        for k in check.tolist():
+            keep[k] = _polygon_intersects_rect(li.label(int(hits[k]))['regions'], bbox)
+        return hits[keep]
+
+    def query_bbox_raw(self, li: LabelIndex, bbox: tuple, accept_gzip: bool = False,
+                       refine: bool = True) -> tuple[bytes, bool]:
+        """Return (JSON array bytes, is_gzipped) for labels intersecting the bbox.
+
+        Hits are spliced from the raw label buffer, so no dicts are built or
+        re-encoded. Only a full match is served gzipped, from the cached copy.
+        """
         li.last_accessed = time.time()
 
-        indices = list(li.rtree.intersection(bbox))
-        return [li.labels[i] for i in indices]
+        indices = self._query_indices(li, bbox, refine)
+        if accept_gzip and len(indices) == li.label_count:
+            return li.gzipped(), True
+        return li.encode(indices), False
 
-    def query_bbox_lod(self, blob_path: str, bbox: tuple, max_labels: int) -> list[dict]:
-        """Return labels intersecting bbox, simplified to centroids if over max_labels."""
-        li = self._indexes.get(blob_path)
-        if not li:
-            return []
+    def query_bbox_ndjson(self, li: LabelIndex, bbox: tuple, refine: bool = True) -> Iterator[bytes]:
+        """Chunked NDJSON for labels intersecting the bbox, spliced lazily from the raw buffer."""
+        li.last_accessed = time.time()
+
+        return li.iter_ndjson(self._query_indices(li, bbox, refine))
 
-        self._indexes.move_to_end(blob_path)
+    def query_bbox_lod(self, li: LabelIndex, bbox: tuple, max_labels: int,
+                       refine: bool = True) -> bytes:
+        """JSON array of labels intersecting bbox, simplified to centroids if over max_labels."""
         li.last_accessed = time.time()
 
-        indices = list(li.rtree.intersection(bbox))
+        indices = self._query_indices(li, bbox, refine)
 
         if len(indices) <= max_labels:
-            return [li.labels[i] for i in indices]
+            return li.encode(indices)
 
         # Over budget: subsample evenly and return centroid-only representations
         step = max(1, len(indices) // max_labels)
         sampled = indices[::step][:max_labels]
 
+        raw = memoryview(li.labels_raw)
         result = []
-        for i in sampled:
-            label = li.labels[i]
-            cx, cy = li.centroids[i]
-            simplified = {
-                "_id": label.get("_id", str(i)),
-                "label_class": label.get("label_class", ""),
-                "label_type": label.get("label_type", "cell"),
-                "source": label.get("source", ""),
-                "position": {"x": cx, "y": cy},
-                "_simplified": True,
-            }
-            result.append(simplified)
-        return result
+        for i in sampled.tolist():
+            meta = _decode_label_meta(raw[li.offsets[i] + 1:li.offsets[i + 1]])
+            cx, cy = li.centroid(i)
+            result.append(SimplifiedLabel(
+                id=str(i) if meta.id is None else meta.id,
+                label_class=meta.label_class,
+                label_type=meta.label_type,
+                source=meta.source,
+                position=_Position(cx, cy),
+            ))
+        return _encode_json(result)
 
     # ── Tile rendering ──────────────────────────────────────────────────────
 
@@ -199,11 +624,8 @@ class SpatialIndexManager:
     STROKE_COLOR = (0, 120, 255, 200) # solid blue stroke
     POINT_RADIUS = 3
 
-    def get_tile_info(self, blob_path: str) -> dict | None:
+    def get_tile_info(self, li: LabelIndex) -> dict | None:
         """Return DZI-like metadata for building the tile pyramid."""
-        li = self._indexes.get(blob_path)
-        if not li:
-            return None
         w, h = li.image_width, li.image_height
         if w == 0 or h == 0:
             return None
@@ -217,13 +639,8 @@ class SpatialIndexManager:
             "total_labels": li.label_count,
         }
 
-    def render_tile(self, blob_path: str, level: int, col: int, row: int) -> bytes | None:
+    def render_tile(self, li: LabelIndex, level: int, col: int, row: int) -> bytes | None:
         """JIT-render a label tile as RGBA PNG."""
-        li = self._indexes.get(blob_path)
-        if not li:
-            return None
-
-        self._indexes.move_to_end(blob_path)
         li.last_accessed = time.time()
 
         ts = self.TILE_SIZE
@@ -235,9 +652,9 @@ class SpatialIndexManager:
         scale = ts * (2 ** (max_level - level)) # image pixels per tile
         bbox = (col * scale, row * scale, (col + 1) * scale, (row + 1) * scale)
 
-        # Query R-tree
-        indices = list(li.rtree.intersection(bbox))
-        if not indices:
+        # The rasterizer clips to the tile, so bbox hits are enough here
+        indices = self._query_indices(li, bbox, refine=False)
+        if len(indices) == 0:
             return None  # empty tile, caller returns 204
 
         # Coordinate transform: image coords -> tile pixel coords
@@ -247,11 +664,11 @@ class SpatialIndexManager:
         img = Image.new('RGBA', (ts, ts), (0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
 
-        for i in indices:
-            label = li.labels[i]
-            regions = label.get('regions')
-            if regions:
-                for ring in regions:
+        kinds = li.kinds[indices].tolist()
+        for i, kind in zip(indices.tolist(), kinds):
+            if kind == KIND_POLYGON:
+                # Only polygons need their geometry decoded
+                for ring in li.label(i)['regions']:
                     if len(ring) < 3:
                         continue
                     poly = [(int((pt['x'] - ox) * px_per_unit),
@@ -259,7 +676,7 @@ class SpatialIndexManager:
                     draw.polygon(poly, fill=self.FILL_COLOR, outline=self.STROKE_COLOR)
             else:
                 # Point or centroid
-                cx, cy = li.centroids[i]
+                cx, cy = li.centroid(i)
                 px = int((cx - ox) * px_per_unit)
                 py = int((cy - oy) * px_per_unit)
                 r = self.POINT_RADIUS
@@ -276,18 +693,54 @@ class SpatialIndexManager:
         key = f"{blob_path}:{li.label_count if li else 0}:{level}:{col}:{row}"
         return hashlib.md5(key.encode()).hexdigest()[:16]
 
+    def version(self, blob_path: str) -> int:
+        """Counter that changes whenever the blob's index is rebuilt or dropped."""
+        return self._versions.get(blob_path, 0)
+
+    def _insert(self, blob_path: str, label_index: LabelIndex, version: int) -> bool:
+        """Publish a freshly built index unless the blob was invalidated mid-build.
+
+        A build that started before an invalidate read the old file, so it is
+        handed back to its caller but never cached. Returns whether it was.
+        """
+        with self._lock:
+            if self._versions.get(blob_path, 0) != version:
+                return False
+            self._drop(blob_path)
+            self._indexes[blob_path] = label_index
+            self._total_mb += label_index.memory_estimate_mb
+            self._total_labels += label_index.label_count
+            label_index.version = self._versions[blob_path]
+            return True
+
+    def invalidate(self, blob_path: str):
+        """Drop an index from memory and forget any failed build (no-op if absent)."""
+        with self._lock:
+            self._drop(blob_path)
+            self._index_status.pop(blob_path, None)
+
+    def _drop(self, blob_path: str):
+        # Caller holds self._lock
+        li = self._indexes.pop(blob_path, None)
+        if li is not None:
+            self._total_mb -= li.memory_estimate_mb
+            self._total_labels -= li.label_count
+        self._versions[blob_path] = self._versions.get(blob_path, 0) + 1
+        if self.on_drop is not None:
+            self.on_drop(blob_path)
+
     def _evict_if_needed(self):
-        total_mb = sum(li.memory_estimate_mb for li in self._indexes.values())
-        while (len(self._indexes) > self.max_indexes or total_mb > self.max_memory_mb) and self._indexes:
-            oldest_key, oldest = next(iter(self._indexes.items()))
-            total_mb -= oldest.memory_estimate_mb
-            del self._indexes[oldest_key]
-            logger.info(f"Evicted index: {oldest_key}")
+        with self._lock:
+            while (len(self._indexes) > self.max_indexes or self._total_mb > self.max_memory_mb) and self._indexes:
+                sample = random.sample(tuple(self._indexes), min(self.EVICTION_SAMPLES, len(self._indexes)))
+                victim = min(sample, key=lambda k: self._indexes[k].last_accessed)
+                self._drop(victim)
+                logger.info("Evicted index: %s", victim)
 
     @property
     def stats(self) -> dict:
         return {
             "indexed_jobs": len(self._indexes),
-            "total_labels": sum(li.label_count for li in self._indexes.values()),
-            "total_memory_mb": round(sum(li.memory_estimate_mb for li in self._indexes.values()), 1),
+            "total_labels": self._total_labels,
+            "total_memory_mb": round(self._total_mb, 1),
         }
@@ -1,97 +1,211 @@
 import asyncio
-import json
+import functools
+import hashlib
+import hmac
 import logging
+import math
 import os
 import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import cachetools
 import jwt as pyjwt
 from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from .cache import label_blob_cache
 from .config import settings
-from .index import SpatialIndexManager
+from .index import LabelIndex, SpatialIndexManager, shutdown_bbox_pool
 
+logging.basicConfig(level=settings.log_level.upper())
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Label Cache Server")
 spatial_manager = SpatialIndexManager(
     max_indexes=settings.max_indexed_jobs,
-    max_memory_mb=settings.max_index_memory_mb
+    max_memory_mb=settings.max_index_memory_mb,
+    chunk_size=settings.chunk_size,
+    bbox_dtype=settings.bbox_dtype,
+    # Every uvicorn worker gets its own pool, so split the CPUs between them
+    build_processes=settings.build_processes or max(
+        1, (os.cpu_count() or 1) // (settings.workers or 2 * (os.cpu_count() or 1) + 1)
+    ),
 )
 
+# Index queries and tile renders get their own pool so they never queue behind
+# index builds (or blob downloads, which stay on the loop's default executor)
+_query_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="rtree")
+_build_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="index-build")
+
+
+async def run_in_pool(pool: ThreadPoolExecutor, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+def is_cheap_query(li: LabelIndex, bbox: tuple, refine: bool) -> bool:
+    """Predict whether a query costs less than the hop to the query pool.
+
+    Scans are O(label_count); tree lookups scale with the bbox area instead.
+    Refinement decodes and tests polygons of unbounded size in Python, so a
+    refined query on an index with polygons never counts as cheap.
+    """
+    if refine and li.polygon_count:
+        return False
+    if li.label_count < settings.inline_label_threshold:
+        return True
+    min_x, min_y, max_x, max_y = bbox
+    return li.rtree is not None and (max_x - min_x) * (max_y - min_y) < settings.inline_area_threshold
+
+
+async def run_query(inline: bool, fn, *args):
+    """Run fn on the event loop when inline, else on the query pool."""
+    if inline:
+        return fn(*args)
+    return await run_in_pool(_query_pool, fn, *args)
+
+
+@app.on_event("shutdown")
+def _shutdown_pools():
+    _query_pool.shutdown(wait=False, cancel_futures=True)
+    _build_pool.shutdown(wait=False, cancel_futures=True)
+    shutdown_bbox_pool()
+
 # --- Middleware ---
 
-class AuthMiddleware(BaseHTTPMiddleware):
+# Verified JWT payloads keyed by truncated sha256(token); failures are never cached
+_jwt_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=4096, ttl=5)
+_jwt_cache_lock = threading.Lock()
+JWT_CACHE_MAX_SECONDS = 30
+
+# Resolved once at import instead of on every request
+_JWT = pyjwt.PyJWT(options={"require": ["exp", "sub", "iss"], "verify_signature": True})
+_JWT_ALGS = ("HS256",)
+_JWT_SECRET = settings.jwt_secret
+_API_KEY = settings.api_key.encode()
+_AUTH_DISABLED = not _JWT_SECRET and not _API_KEY
+
+
+def is_api_key(token: str) -> bool:
+    """Constant-time comparison against the static server-to-server key."""
+    return bool(_API_KEY) and hmac.compare_digest(token.encode(), _API_KEY)
+
+
+def verify_jwt(token: str) -> dict:
+    """Decode and verify a JWT, reusing a recent verification of the same token.
+
+    Raises pyjwt.InvalidTokenError (including ExpiredSignatureError) on failure.
+    """
+    key = hashlib.sha256(token.encode()).digest()[:16]
+    now = time.time()
+    with _jwt_cache_lock:
+        hit = _jwt_cache.get(key)
+    if hit is not None and hit[1] > now:
+        return hit[0]
+
+    payload = _JWT.decode(token, _JWT_SECRET, algorithms=_JWT_ALGS)
+    valid_until = min(payload["exp"], now + JWT_CACHE_MAX_SECONDS)
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (payload, valid_until)
+    return payload
+
+
+def _set_user(scope: Scope, payload: dict) -> None:
+    """Expose JWT claims as request.state.* (Request.state is backed by scope["state"])."""
+    state = scope.setdefault("state", {})
+    state["user_id"] = payload.get("sub")
+    state["user_email"] = payload.get("email", "")
+    state["projects"] = payload.get("projects", [])
+
+
+def _query_token(scope: Scope) -> str:
+    query_string = scope.get("query_string", b"")
+    if b"token=" not in query_string:
+        return ""
+    return dict(parse_qsl(query_string.decode("latin-1"))).get("token", "")
+
+
+async def _reject(send: Send, body: bytes) -> None:
+    # Messages are built per call: downstream send wrappers (CORS) mutate the headers list
+    await send({
+        "type": "http.response.start",
+        "status": 401,
+        "headers": [(b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AuthMiddleware:
     """Dual auth: JWT (browser clients) + static API key (server-to-server).
 
     If neither jwt_secret nor api_key is configured, all requests pass (dev mode).
+    Plain ASGI rather than BaseHTTPMiddleware, so passing requests are handed
+    straight to the app without a task group or response-body shim.
     """
-    OPEN_PATHS = {"/health", "/docs", "/openapi.json"}
+    OPEN_PATHS = frozenset(("/health", "/docs", "/openapi.json"))  # matched against raw scope["path"]
     OPEN_PREFIXES = ()  # tile auth now handled via ?token= JWT query param
 
-    async def dispatch(self, request: Request, call_next):
-        # Dev mode: no auth configured
-        if not settings.jwt_secret and not settings.api_key:
-            return await call_next(request)
-
-        # Open paths always pass
-        if request.url.path in self.OPEN_PATHS:
-            return await call_next(request)
-        if any(request.url.path.startswith(p) for p in self.OPEN_PREFIXES):
-            return await call_next(request)
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
-        auth = request.headers.get("authorization", "")
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # Dev mode (no auth configured) and non-HTTP scopes pass straight through
+        if _AUTH_DISABLED or scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
-        if auth.startswith("Bearer "):
+        # Open paths always pass
+        path = scope["path"]
+        if path in self.OPEN_PATHS:
+            return await self.app(scope, receive, send)
+        if any(path.startswith(p) for p in self.OPEN_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        auth = ""
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                auth = value.decode("latin-1")
+                break
+
+        if len(auth) > 7 and auth[:7] == "Bearer ":
             token = auth[7:]
 
-            # 1. Static API key check (cheap string compare — server-to-server)
-            if settings.api_key and token == settings.api_key:
-                return await call_next(request)
+            # 1. Static API key check (cheap constant-time compare — server-to-server)
+            if is_api_key(token):
+                return await self.app(scope, receive, send)
 
             # 2. JWT validation (browser clients)
-            if settings.jwt_secret:
+            if _JWT_SECRET:
                 try:
-                    payload = pyjwt.decode(
-                        token,
-                        settings.jwt_secret,
-                        algorithms=["HS256"],
-                        options={"require": ["exp", "sub", "iss"]},
-                    )
-                    if payload.get("iss") != "azure-studio":
-                        return Response(status_code=401, content="Invalid token issuer")
-                    request.state.user_id = payload.get("sub")
-                    request.state.user_email = payload.get("email", "")
-                    request.state.projects = payload.get("projects", [])
-                    return await call_next(request)
+                    payload = verify_jwt(token)
                 except pyjwt.ExpiredSignatureError:
-                    return Response(status_code=401, content="Token expired")
+                    return await _reject(send, b"Token expired")
                 except pyjwt.InvalidTokenError:
-                    pass  # Fall through
+                    payload = None  # Fall through
+                if payload is not None:
+                    if payload.get("iss") != "azure-studio":
+                        return await _reject(send, b"Invalid token issuer")
+                    _set_user(scope, payload)
+                    return await self.app(scope, receive, send)
 
         # 3. Query param fallback (?token= for <img> tags that can't send headers)
-        token_param = request.query_params.get("token", "")
+        token_param = _query_token(scope)
         if token_param:
-            if settings.api_key and token_param == settings.api_key:
-                return await call_next(request)
-            if settings.jwt_secret:
+            if is_api_key(token_param):
+                return await self.app(scope, receive, send)
+            if _JWT_SECRET:
                 try:
-                    payload = pyjwt.decode(
-                        token_param,
-                        settings.jwt_secret,
-                        algorithms=["HS256"],
-                        options={"require": ["exp", "sub", "iss"]},
-                    )
-                    if payload.get("iss") == "azure-studio":
-                        request.state.user_id = payload.get("sub")
-                        request.state.user_email = payload.get("email", "")
-                        request.state.projects = payload.get("projects", [])
-                        return await call_next(request)
+                    payload = verify_jwt(token_param)
                 except pyjwt.InvalidTokenError:
-                    pass
+                    payload = None
+                if payload is not None and payload.get("iss") == "azure-studio":
+                    _set_user(scope, payload)
+                    return await self.app(scope, receive, send)
 
-        return Response(status_code=401, content="Unauthorized")
+        await _reject(send, b"Unauthorized")
 
 app.add_middleware(AuthMiddleware)
 app.add_middleware(
@@ -134,6 +248,148 @@ def validate_project_access(request: Request, blob_path: str) -> None:
         raise HTTPException(403, "Access denied to this project")
 
 
+# One fetch-and-build task per blob_path; concurrent requests await the same one
+_build_inflight: dict[str, asyncio.Future] = {}
+BUILD_RETRY_SECONDS = 300  # /labels/stats won't re-warm a blob whose build failed this recently
+
+
+def build_failed_recently(blob_path: str) -> bool:
+    """True while a failed build should not be retried by background warm-ups.
+
+    Cleared by /labels/invalidate or once BUILD_RETRY_SECONDS have passed;
+    /labels itself still retries, so callers see the error.
+    """
+    status = spatial_manager.get_index_status(blob_path)
+    return (status is not None and status["status"] == "error"
+            and time.time() - status["failed_at"] < BUILD_RETRY_SECONDS)
+
+
+async def ensure_index(blob_path: str) -> LabelIndex:
+    """Make sure the blob is cached locally and its spatial index is built.
+
+    The blob_path is used as the index cache key directly. Concurrent callers
+    for the same blob share a single build; the build is shielded, so a
+    disconnecting client doesn't cancel it for everyone else.
+    """
+    # Warm path stays on the event loop: no blob lookup, no queueing behind builds
+    li = spatial_manager.peek(blob_path)
+    if li is not None:
+        li.last_accessed = time.time()
+        return li
+    return await asyncio.shield(start_build(blob_path))
+
+
+def start_build(blob_path: str) -> asyncio.Future:
+    """Return the in-flight fetch-and-build for blob_path, starting one if needed.
+
+    Not awaiting the result makes this a background warm-up; failures are
+    logged by the build itself and surface again on the next real request.
+    """
+    fut = _build_inflight.get(blob_path)
+    if fut is None:
+        fut = asyncio.ensure_future(_fetch_and_build(blob_path))
+        _build_inflight[blob_path] = fut
+        fut.add_done_callback(functools.partial(_build_done, blob_path))
+    return fut
+
+
+def _build_done(blob_path: str, fut: asyncio.Future) -> None:
+    if _build_inflight.get(blob_path) is fut:
+        del _build_inflight[blob_path]
+    if not fut.cancelled():
+        fut.exception()  # mark retrieved even if every waiter went away
+
+
+async def _fetch_and_build(blob_path: str) -> LabelIndex:
+    try:
+        local_path = await label_blob_cache.get_raw(blob_path)
+    except Exception as e:
+        logger.error("Blob not found: %s: %s", blob_path, e)
+        raise HTTPException(404, f"Annotation file not found: {blob_path}")
+
+    try:
+        return await run_in_pool(
+            _build_pool, spatial_manager.get_or_build, blob_path, local_path
+        )
+    except Exception as e:
+        logger.exception("Index build failed: %s", blob_path)
+        raise HTTPException(500, f"Failed to index annotations: {e}")
+
+
+# LRU of /labels response bodies across all blobs, bounded by their total size.
+# Keys are (blob_path, index version, quantized bbox, gzip, refine); a blob's
+# entries are dropped as soon as its index is evicted, replaced or invalidated.
+BBOX_QUANTUM = 8  # px; bboxes are snapped outward so near-identical pans share a slot
+class ResponseCache(cachetools.LRUCache):
+    """Byte-bounded LRU that also indexes its keys by blob_path (key[0]).
+
+    Every removal, including LRU eviction, goes through __delitem__, so the
+    side index stays exact and dropping a blob touches only its own entries.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize, getsizeof=lambda v: len(v[0]))
+        self.by_blob: dict[str, set[tuple]] = {}
+
+    def __setitem__(self, key: tuple, value: tuple[bytes, bool]):
+        super().__setitem__(key, value)
+        self.by_blob.setdefault(key[0], set()).add(key)
+
+    def __delitem__(self, key: tuple):
+        super().__delitem__(key)
+        keys = self.by_blob.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_blob[key[0]]
+
+
+_response_cache = ResponseCache(maxsize=int(settings.response_cache_mb * 1024 * 1024))
+_response_cache_lock = threading.Lock()  # drops arrive from index build threads
+
+
+def labels_etag(li: LabelIndex, *key) -> str:
+    """Weak ETag for a /labels response: source file stamp + hash of the query params.
+
+    The stamp is the (size, mtime) of the shared on-disk blob cache file the
+    index was built from, so every worker, and a restarted server, hands out
+    the same tag for the same data. Weak because the labels may be gzipped.
+    """
+    size, mtime_ns = li.source_stamp
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+    return f'W/"{size:x}-{mtime_ns:x}-{digest}"'
+
+
+def quantize_bbox(bbox: tuple[float, ...]) -> tuple[int, int, int, int]:
+    q = BBOX_QUANTUM
+    min_x, min_y, max_x, max_y = bbox
+    return (math.floor(min_x / q) * q, math.floor(min_y / q) * q,
+            math.ceil(max_x / q) * q, math.ceil(max_y / q) * q)
+
+
+def cached_response(key: tuple) -> tuple[bytes, bool] | None:
+    with _response_cache_lock:
+        return _response_cache.get(key)
+
+
+def store_response(key: tuple, value: tuple[bytes, bool]) -> None:
+    with _response_cache_lock:
+        try:
+            _response_cache[key] = value
+        except ValueError:
+            pass  # body alone is bigger than the whole cache
+
+
+def drop_responses(blob_path: str) -> None:
+    """Forget a blob's cached bodies (they may pin its evicted index's buffers)."""
+    with _response_cache_lock:
+        for key in list(_response_cache.by_blob.get(blob_path, ())):
+            del _response_cache[key]
+
+
+spatial_manager.on_drop = drop_responses
+
+
 # --- Endpoints ---
 
 @app.get("/health")
@@ -147,31 +403,24 @@ async def health():
 
 
 @app.get("/labels")
-async def get_labels(blob_path: str, request: Request, bbox: str | None = None, max_labels: int | None = None):
+async def get_labels(blob_path: str, request: Request, bbox: str | None = None,
+                     max_labels: int | None = None, refine: bool = True):
     """Return labels within a bounding box.
 
     blob_path: full Azure Blob path (used as cache key directly)
     bbox format: minX,minY,maxX,maxY (image pixel coordinates)
     max_labels: if set, returns simplified centroids when result exceeds this count (LOD)
+    refine: exact polygon test against the bbox; points and boxes are matched on
+        their stored bbox, which may reach up to 1px past the label with the int32
+        bbox_dtype. refine=false returns every label whose stored bounding box
+        intersects (cheaper, fine for zoomed-out overviews)
+    Clients sending Accept: application/x-ndjson get labels streamed one per line.
     If bbox is omitted, returns metadata/stats only (not all labels).
     """
+    blob_path = sys.intern(blob_path)  # repeated polling keys then compare by identity
     validate_project_access(request, blob_path)
 
-    # Ensure blob is cached locally
-    try:
-        local_path = await label_blob_cache.get(blob_path)
-    except Exception as e:
-        logger.error(f"Blob not found: {blob_path}: {e}")
-        raise HTTPException(404, f"Annotation file not found: {blob_path}")
-
-    # Ensure spatial index is built (use blob_path as cache key directly)
-    try:
-        label_index = await asyncio.to_thread(
-            spatial_manager.get_or_build, blob_path, local_path
-        )
-    except Exception as e:
-        logger.error(f"Index build failed: {e}")
-        raise HTTPException(500, f"Failed to index annotations: {e}")
+    label_index = await ensure_index(blob_path)
 
     if bbox is None:
         # Stats-only response (no labels payload)
@@ -183,42 +432,85 @@ async def get_labels(blob_path: str, request: Request, bbox: str | None = None,
 
     # Parse bbox and query R-tree
     try:
-        parts = [float(x) for x in bbox.split(",")]
-        assert len(parts) == 4
-        bbox_tuple = tuple(parts)
-    except (ValueError, AssertionError):
+        min_x, min_y, max_x, max_y = map(float, bbox.split(","))
+    except ValueError:  # non-numeric part or wrong number of parts
         raise HTTPException(400, "bbox must be minX,minY,maxX,maxY")
+    bbox_tuple = (min_x, min_y, max_x, max_y)
+    if not all(map(math.isfinite, bbox_tuple)):  # float() accepts inf/nan
+        raise HTTPException(400, "bbox must be minX,minY,maxX,maxY")
+
+    lod = bool(max_labels and max_labels > 0)
+    ndjson = not lod and "application/x-ndjson" in request.headers.get("accept", "")
+    qbox = quantize_bbox(bbox_tuple)
 
-    if max_labels and max_labels > 0:
-        labels = await asyncio.to_thread(
-            spatial_manager.query_bbox_lod, blob_path, bbox_tuple, max_labels
+    headers = {
+        "Cache-Control": "no-cache",  # labels can change via edits; revalidate via ETag
+        "Vary": "Accept, Accept-Encoding",
+    }
+    # Labels only change when the blob is re-downloaded, which gives the cached
+    # file a new stamp, so a matching tag skips the query entirely.
+    headers["ETag"] = labels_etag(label_index, bbox_tuple if lod or ndjson else qbox,
+                                  max_labels, refine, ndjson)
+    if request.headers.get("if-none-match", "") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    # An index dropped (or never published) since ensure_index returned it is
+    # still queried, but its response is not cached.
+    current = label_index.version == spatial_manager.version(blob_path)
+
+    inline = is_cheap_query(label_index, bbox_tuple, refine)
+    if lod:
+        content = await run_query(
+            inline, spatial_manager.query_bbox_lod, label_index, bbox_tuple, max_labels, refine
         )
-    else:
-        labels = await asyncio.to_thread(
-            spatial_manager.query_bbox, blob_path, bbox_tuple
+    elif ndjson:
+        # Opt-in streaming: one label per line, spliced in batches as the body is sent
+        chunks = await run_query(
+            inline, spatial_manager.query_bbox_ndjson, label_index, bbox_tuple, refine
         )
-
-    return Response(
-        content=json.dumps(labels, separators=(',', ':')),
-        media_type="application/json",
-        headers={"Cache-Control": "no-cache"},  # labels can change via edits
-    )
+        return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
+    else:
+        accept_gzip = "gzip" in request.headers.get("accept-encoding", "")
+        key = (blob_path, label_index.version, qbox, accept_gzip, refine)
+        hit = cached_response(key) if current else None
+        if hit is None:
+            # The first gzipped full-extent hit compresses the whole buffer: never inline
+            inline = inline and not (accept_gzip and label_index.labels_gz is None)
+            hit = await run_query(
+                inline, spatial_manager.query_bbox_raw, label_index, qbox, accept_gzip, refine
+            )
+            if current:
+                store_response(key, hit)
+        content, gzipped = hit
+        if gzipped:
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @app.get("/labels/stats")
 async def label_stats(blob_path: str, request: Request):
-    """Quick stats without building full index."""
-    validate_project_access(request, blob_path)
-    try:
-        local_path = await label_blob_cache.get(blob_path)
-    except Exception:
-        raise HTTPException(404, "Annotation file not found")
+    """Quick stats without waiting for the index.
 
-    size = os.path.getsize(local_path)
+    Also starts building the index in the background, so it is usually warm
+    by the time the client asks for labels.
+    """
+    blob_path = sys.intern(blob_path)
+    validate_project_access(request, blob_path)
+    size = label_blob_cache.cached_size(blob_path)
+    if size is None:
+        try:
+            await label_blob_cache.get(blob_path)
+        except Exception:
+            raise HTTPException(404, "Annotation file not found")
+        size = label_blob_cache.cached_size(blob_path) or 0
+
+    is_indexed = spatial_manager.is_indexed(blob_path)
+    if not is_indexed and not build_failed_recently(blob_path):
+        start_build(blob_path)
     return {
         "blob_path": blob_path,
         "compressed_size_mb": round(size / (1024 * 1024), 1),
-        "is_indexed": blob_path in spatial_manager._indexes,
+        "is_indexed": is_indexed,
     }
 
 
@@ -229,9 +521,11 @@ async def label_status(blob_path: str, request: Request):
     Returns the current state of blob download and spatial index
     so the frontend can show progress indicators.
     """
+    blob_path = sys.intern(blob_path)
     validate_project_access(request, blob_path)
     cache_status = label_blob_cache.get_status(blob_path)
-    is_indexed = blob_path in spatial_manager._indexes
+    li = spatial_manager.peek(blob_path)
+    is_indexed = li is not None
     index_status = spatial_manager.get_index_status(blob_path)
 
     result = {
@@ -242,10 +536,8 @@ async def label_status(blob_path: str, request: Request):
     if index_status:
         result["index"] = index_status
     if is_indexed:
-        li = spatial_manager._indexes.get(blob_path)
-        if li:
-            result["total_labels"] = li.label_count
-            result["memory_mb"] = round(li.memory_estimate_mb, 1)
+        result["total_labels"] = li.label_count
+        result["memory_mb"] = round(li.memory_estimate_mb, 1)
     return result
 
 
@@ -253,19 +545,9 @@ async def label_status(blob_path: str, request: Request):
 async def tile_info(blob_path: str, request: Request):
     """Return DZI-like metadata for the label tile pyramid."""
     validate_project_access(request, blob_path)
-    try:
-        local_path = await label_blob_cache.get(blob_path)
-    except Exception as e:
-        raise HTTPException(404, f"Annotation file not found: {blob_path}")
+    label_index = await ensure_index(blob_path)
 
-    try:
-        label_index = await asyncio.to_thread(
-            spatial_manager.get_or_build, blob_path, local_path
-        )
-    except Exception as e:
-        raise HTTPException(500, f"Failed to index: {e}")
-
-    info = spatial_manager.get_tile_info(blob_path)
+    info = spatial_manager.get_tile_info(label_index)
     if not info:
         raise HTTPException(404, "No tile info available")
     return info
@@ -274,6 +556,7 @@ async def tile_info(blob_path: str, request: Request):
 @app.get("/labels/tiles/{level}/{col}_{row}.png")
 async def get_tile(blob_path: str, level: int, col: int, row: int, request: Request):
     """JIT-render a label tile as RGBA PNG."""
+    blob_path = sys.intern(blob_path)
     validate_project_access(request, blob_path)
 
     # ETag support
@@ -282,22 +565,11 @@ async def get_tile(blob_path: str, level: int, col: int, row: int, request: Requ
     if if_none_match == etag:
         return Response(status_code=304)
 
-    # Ensure index is built
-    try:
-        local_path = await label_blob_cache.get(blob_path)
-    except Exception:
-        raise HTTPException(404, "Annotation file not found")
-
-    try:
-        await asyncio.to_thread(
-            spatial_manager.get_or_build, blob_path, local_path
-        )
-    except Exception as e:
-        raise HTTPException(500, f"Failed to index: {e}")
+    label_index = await ensure_index(blob_path)
 
     # Render tile
-    png_bytes = await asyncio.to_thread(
-        spatial_manager.render_tile, blob_path, level, col, row
+    png_bytes = await run_in_pool(
+        _query_pool, spatial_manager.render_tile, label_index, level, col, row
     )
 
     if png_bytes is None:
@@ -318,8 +590,9 @@ async def get_tile(blob_path: str, level: int, col: int, row: int, request: Requ
 async def invalidate_cache(blob_path: str, request: Request):
     """Called by azure-studio after a save to bust the cache."""
     validate_project_access(request, blob_path)
-    if blob_path in spatial_manager._indexes:
-        del spatial_manager._indexes[blob_path]
+    spatial_manager.invalidate(blob_path)  # also drops its cached responses
+    # Later requests must not join a build that may have read the old file
+    _build_inflight.pop(blob_path, None)
 
     # Also remove the cached blob so next request re-downloads
     label_blob_cache.remove(blob_path)
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from labelserver.index import SpatialIndexManager
+
+LABELS = [
+    {"_id": "point", "position": {"x": 10.5, "y": 10.5}},
+    {"_id": "box", "centre": {"x": 100, "y": 100}, "size": {"x": 20, "y": 10}},
+    {"_id": "poly", "regions": [[{"x": 200, "y": 200}, {"x": 300, "y": 200}, {"x": 200, "y": 300}]]},
+    {"_id": "no-geometry"},
+]
+
+
+@pytest.fixture(params=["int32", "float32"])
+def built(request, tmp_path):
+    path = tmp_path / "labels.json"
+    path.write_text(json.dumps({"labels": LABELS, "image_width": 1000, "image_height": 800}))
+    manager = SpatialIndexManager(bbox_dtype=request.param)
+    return manager, manager.get_or_build("blob", str(path))
+
+
+def ids(body: bytes) -> list[str]:
+    return [label["_id"] for label in json.loads(body)]
+
+
+def test_build(built):
+    manager, li = built
+    assert li.label_count == 4
+    assert (li.image_width, li.image_height) == (1000, 800)
+    assert manager.is_indexed("blob")
+    assert li.label(3) == LABELS[3]
+
+
+def test_source_stamp_tracks_cached_file(built, tmp_path):
+    _, li = built
+    st = (tmp_path / "labels.json").stat()
+    assert li.source_stamp == (st.st_size, st.st_mtime_ns)
+
+
+@pytest.mark.parametrize("bbox, expected", [
+    ((0, 0, 50, 50), ["point"]),
+    ((85, 90, 95, 100), ["box"]),
+    ((250, 190, 260, 210), ["poly"]),
+    ((400, 400, 500, 500), []),
+    ((0, 0, 1000, 1000), ["point", "box", "poly"]),
+])
+def test_query_bbox_raw(built, bbox, expected):
+    manager, li = built
+    body, gzipped = manager.query_bbox_raw(li, bbox)
+    assert not gzipped
+    assert ids(body) == expected
+
+
+def test_refine_drops_polygon_outside_outline(built):
+    manager, li = built
+    bbox = (280, 280, 290, 290)  # inside the triangle's bbox, beyond its hypotenuse
+    assert ids(manager.query_bbox_raw(li, bbox)[0]) == []
+    assert ids(manager.query_bbox_raw(li, bbox, refine=False)[0]) == ["poly"]
+
+
+def test_ndjson_matches_json(built):
+    manager, li = built
+    lines = b"".join(manager.query_bbox_ndjson(li, (0, 0, 1000, 1000))).splitlines()
+    assert [json.loads(line)["_id"] for line in lines] == ["point", "box", "poly"]
+
+
+def test_failed_build_reports_error_until_invalidated(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text("{not json")
+    manager = SpatialIndexManager()
+    with pytest.raises(Exception):
+        manager.get_or_build("broken", str(path))
+    status = manager.get_index_status("broken")
+    assert status["status"] == "error" and status["failed_at"] > 0
+    manager.invalidate("broken")
+    assert manager.get_index_status("broken") is None